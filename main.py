@@ -1,18 +1,24 @@
 import os
+import sys
 import json
 import logging
-from time import sleep
-from datetime import datetime
-import requests
-from dotenv import load_dotenv
+import sqlite3
+import argparse
 import util
-import pandas as pd
-from sqlalchemy import create_engine, MetaData, Table, Column, String, Float, exc, inspect, text, select, func
-from sqlalchemy.exc import SQLAlchemyError
+import nutrient_stats
+from records import CATALOG, FoodRecord, to_mg
+
+# pandas, SQLAlchemy, requests and dotenv are imported inside the functions
+# that need them, so that query and stats start without paying their cost.
 
 
 # Adda list of valid foods. Check example_corrected_foods.txt or directly the USDA Site
 CORRECTED_FOODS = 'example_corrected_foods.txt' # 'example_corrected_foods.txt'
+FOODS = 'foods.txt'
+# File the names resolved from foods.txt are appended to
+RESOLVED_FOODS = 'example_corrected_foods.txt'
+DB_FILE = 'food_components.db'
+FOODS_TABLE = 'foods_data'
 
 def convert_to_mg(data):
     '''
@@ -20,12 +26,7 @@ def convert_to_mg(data):
     '''
     processed_data = []
     for mineral, value, unit in data:
-        if unit == 'µg':
-            value_mg = value / 1000  # Convert µg to mg
-        elif unit == 'g':
-            value_mg = value * 1000  # Convert g to mg
-        else:
-            value_mg = value
+        value_mg, _ = to_mg(value, unit)
         # if '<' in value:
         #     numeric_value = float(value.replace('<', ''))
         #     if unit == 'µg':
@@ -61,6 +62,8 @@ def get_record_count(connection, table):
     '''
     Get the count of records in a specified database table.
     '''
+    from sqlalchemy import select, func
+
     count_stmt = select((func.count())).select_from(table)
     result = connection.execute(count_stmt)
     count = result.scalar()
@@ -69,7 +72,12 @@ def get_record_count(connection, table):
 def save_to_db(df, table_name, db_path='sqlite:///food_components.db'):
     '''
     Save a DataFrame into its specific table in food_components.db.
+    Return True if the records were committed, False otherwise.
     '''
+    import pandas as pd
+    from sqlalchemy import create_engine, MetaData, Table, Column, String, exc, inspect, text, select, func
+    from sqlalchemy.exc import SQLAlchemyError
+
     logging.info('Starting save_to_db function')
     engine = create_engine(db_path)
     meta = MetaData()
@@ -132,6 +140,7 @@ def save_to_db(df, table_name, db_path='sqlite:///food_components.db'):
         table = Table(table_name, meta, autoload_with=engine)
 
     # Insert or update the record
+    saved = False
     with engine.connect() as connection:
         transaction = connection.begin()
         try:
@@ -141,32 +150,39 @@ def save_to_db(df, table_name, db_path='sqlite:///food_components.db'):
 
             for _, row in df.iterrows():
                 data = row.to_dict()
-                # Convert all data to string
-                data = {key: str(value) for key, value in data.items()}
+                # Convert all data to string, leaving out the nutrients the food does not have
+                data = {key: str(value) for key, value in data.items() if pd.notna(value)}
                 logging.info('Data to insert:', data)
                 stmt = table.insert().values(data).prefix_with('OR REPLACE')
                 logging.info('SQL Statement')
                 connection.execute(stmt)
-            transaction.commit()
-            logging.info(f'Data {data["Food"]} inserted successfully to "{table_name}"')
+
+                # OR REPLACE keeps the count unchanged for known foods, so check the row itself
+                found_stmt = select(func.count()).select_from(table).where(table.c.Food == data['Food'])
+                if connection.execute(found_stmt).scalar() != 1:
+                    raise SQLAlchemyError(f'Record {data["Food"]} not found after insertion')
 
             # Count records after insertion
             count_after = get_record_count(connection, table)
             logging.info(f'Record count after insertion: \t\t{count_after}')
 
-            if count_after == count_before:
-                raise SQLAlchemyError('Record count did not change after insertion')
+            transaction.commit()
+            saved = True
+            logging.info(f'Data {data["Food"]} inserted successfully to "{table_name}"')
 
         except SQLAlchemyError as e:
             transaction.rollback()
             logging.error(f'Error inserting data "{table_name}": {e}')
 
     logging.info(f'Completed save_to_db function of "{table_name}"')
+    return saved
 
 def save_to_csv(data, file_path):
     '''
     Save a DataFrame to food_components.csv.
     '''
+    import pandas as pd
+
     if os.path.exists(file_path):
         # If the file exists, read it into a DataFrame
         existing_data = pd.read_csv(file_path)
@@ -420,6 +436,8 @@ def search_single_food_usda(query, API_KEY):
     using the /foods/search endpoint. It retrieves detailed nutritional 
     information for the first food item that matches the given query.
     '''
+    import requests
+
     search_url = f'https://api.nal.usda.gov/fdc/v1/foods/search'
     params = {
         'api_key': API_KEY,
@@ -459,6 +477,8 @@ def get_food_list(API_KEY, page_number, page_size):
     using the /foods/list endpoint. It returns a paginated list of food items 
     along with their descriptions and FDC IDs.
     '''
+    import requests
+
     list_url = 'https://api.nal.usda.gov/fdc/v1/foods/list'
     
     params = {
@@ -487,6 +507,8 @@ def search_all_foods_usda(query, API_KEY):
     using the /foods/search endpoint. It retrieves detailed nutritional 
     information for all food items that match the given query.
     '''
+    import requests
+
     search_url = 'https://api.nal.usda.gov/fdc/v1/foods/search'
     all_foods = []
     page_number = 1
@@ -521,71 +543,293 @@ def search_all_foods_usda(query, API_KEY):
     else:
         return 'No results found.'
 
-def save_data(food_data, food_item):
+def build_record(food_data, food_item):
+    '''
+    Turn the USDA json of a food into a compact FoodRecord with values in mg.
+    '''
     food_data = reduce_json(food_data)
     food_data = json_to_list_of_lists(food_data)
-    food_data = convert_to_mg(food_data[1:])
-    food_data.insert(0, ['Food', food_item])
-    food_data = list_to_dict(food_data)
-    print(food_data)
-    write_to_json(food_data, './jsons/' + food_item + '.json')
-
-    food_data = pd.DataFrame([food_data])
-    save_to_db(food_data, 'foods_data', 'sqlite:///food_components.db')
+    return FoodRecord.from_list(food_item, food_data[1:], CATALOG)
+
+def save_data(records, db_file=DB_FILE):
+    '''
+    Save the records of a run to the jsons, csvs and db in one batch.
+    The name-keyed dicts are only built here, at the writers.
+    '''
+    import pandas as pd
+
+    if not records:
+        return
+
+    for record in records:
+        food_data = record.to_dict()
+        print(food_data)
+        write_to_json(food_data, './jsons/' + record.food + '.json')
+        save_to_csv(pd.DataFrame([food_data]), 'csvs/' + record.food + '.csv')
+
+    food_data = pd.DataFrame([record.to_dict() for record in records])
+    # Keep the statistics in step with foods_data: skip them if the upsert failed
+    if save_to_db(food_data, FOODS_TABLE, 'sqlite:///' + db_file):
+        save_stats(records, db_file)
     save_to_csv(food_data, 'food_components.csv')
-    
-    save_to_csv(food_data, 'csvs/' + food_item + '.csv')
 
-    logging.info(f'Inserted Food:{food_item}')
+    logging.info(f'Inserted {len(records)} foods')
 
-@util.execution_time
-def main():
-    logging.info('Program started')
+def save_stats(records, db_file=DB_FILE):
+    '''
+    Update the nutrient statistics of food_components.db with the saved foods.
+    '''
+    connection = sqlite3.connect(db_file)
+    try:
+        for record in records:
+            names, units = record.catalog.names, record.catalog.units
+            nutrients = {}
+            nutrient_units = {}
+            for nutrient_id, value in record.items():
+                nutrients[names[nutrient_id]] = value
+                nutrient_units[names[nutrient_id]] = units[nutrient_id]
+            try:
+                nutrient_stats.update_stats(connection, record.food, nutrients, nutrient_units)
+            except sqlite3.Error as e:
+                logging.error(f'Error updating the statistics of "{record.food}": {e}')
+    finally:
+        connection.close()
+
+def get_api_key():
+    '''
+    Load environment variables from the .env file and return the USDA API Key.
+    '''
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return os.getenv('USDA_API_KEY')
+
+def resolve_foods(foods, API_KEY):
+    '''
+    Return the USDA descriptions of every food matching the given names.
+    '''
+    corrected_foods = []
+    for food in foods:
+        results = search_all_foods_usda(food, API_KEY)
+        if isinstance(results, list):
+            try:
+                for result in results:
+                    corrected_foods.append(result['description'])
+            except:
+                logging.error(f'Issues adding: {result}')
+        else:
+            logging.error(f'Food not found: {food}')
+            logging.error(f'Food not found: {results}')
+
+    return corrected_foods
+
+def append_to_file(lines, file_path):
+    with open(file_path, 'a') as file:
+        for line in lines:
+            file.write(f"{line}\n")
+
+def connect_existing(db_file, mode='ro'):
+    '''
+    Open the SQLite database with the standard library, read-only ('ro') or
+    read-write ('rw'), without loading SQLAlchemy and without creating the
+    file if it does not exist.
+    '''
+    return sqlite3.connect(f'file:{db_file}?mode={mode}', uri=True)
 
+@util.execution_time
+def run_fetch(args):
+    '''
+    Download the foods from the USDA and save them to the jsons, csvs and db.
+    '''
     # Configure
     util.log_configurator()
     util.jsons_configurator()
     util.csvs_configurator()
 
-    # # Configure the folder where to put the results
-    # results_folder = util.results_configurator()
+    API_KEY = get_api_key()
 
-    # Load environment variables from .env file
-    load_dotenv()
-
-    # Retrieve the USDA API Key from environment variables
-    API_KEY = os.getenv('USDA_API_KEY')
-
-    # Read eated foods or the corrected Version or None of them
-    if CORRECTED_FOODS == '':
-        foods = read_file('foods.txt')
-
-        # Create corrected foods from foods.txt
-        corrected_foods = []
-        for food in foods:
-            results = search_all_foods_usda(food, API_KEY)
-            if isinstance(results, list):
-                try:
-                    for result in results:
-                        corrected_foods.append(result['description'])
-                except:
-                    logging.error(f'Issues adding: {result}')
-            else:
-                logging.error(f'Food not found: {food}')
-                logging.error(f'Food not found: {results}')
-
-        with open('example_corrected_foods.txt', 'a') as file:
-            for food in corrected_foods:
-                file.write(f"{food}\n")
+    # Read the corrected foods or create them from foods.txt
+    if args.foods:
+        foods = read_file(args.foods)
     else:
-        foods = read_file(CORRECTED_FOODS)
+        foods = read_file(FOODS)
+        # The resolved names are only written for later runs: the foods of
+        # foods.txt are still the ones fetched, as the original flow did
+        append_to_file(resolve_foods(foods, API_KEY), args.resolved_output)
 
+    # Keep the compact records of the whole run and save them in one batch
+    records = []
     for food in foods:
-        # food = 'Fish, salmon, chinook, raw'
         food_data = search_single_food_usda(food, API_KEY)
-        save_data(food_data, food)
+        if not isinstance(food_data, dict):
+            logging.error(f'Food not found: {food}: {food_data}')
+            continue
+        records.append(build_record(food_data, food))
+
+    save_data(records, args.db)
 
     logging.info('Program ended successfully')
+    return 0
+
+@util.execution_time
+def run_resolve(args):
+    '''
+    Append the USDA names of the foods in the input file to the output file.
+    '''
+    util.log_configurator()
+
+    foods = resolve_foods(read_file(args.input), get_api_key())
+    append_to_file(foods, args.output)
+    print(f'Resolved {len(foods)} foods into {args.output}')
+
+    logging.info('Program ended successfully')
+    return 0
+
+def run_export(args):
+    '''
+    Export the foods saved in the db to a single csv file.
+    '''
+    import pandas as pd
+
+    try:
+        connection = connect_existing(args.db)
+        try:
+            data = pd.read_sql_query(f'SELECT * FROM {FOODS_TABLE}', connection)
+        finally:
+            connection.close()
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        print(f'Error reading {args.db}: {e}', file=sys.stderr)
+        return 1
+
+    data.to_csv(args.output, index=False)
+    print(f'Exported {len(data)} foods to {args.output}')
+    return 0
+
+def run_query(args):
+    '''
+    Print the nutrients of a food saved in the db.
+    '''
+    try:
+        connection = connect_existing(args.db)
+        try:
+            cursor = connection.execute(f'SELECT * FROM {FOODS_TABLE} WHERE Food = ?', (args.food,))
+            row = cursor.fetchone()
+            columns = [description[0] for description in cursor.description]
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f'Error reading {args.db}: {e}', file=sys.stderr)
+        return 1
+
+    if row is None:
+        print(f'Food not found: {args.food}', file=sys.stderr)
+        return 1
+
+    for column, value in zip(columns, row):
+        if column == 'Food':
+            continue
+        if args.nutrient and args.nutrient.lower() not in column.lower():
+            continue
+        print(f'{column}: {value}')
+    return 0
+
+def run_stats(args):
+    '''
+    Print how many foods and nutrients are saved in the db, the distribution
+    of the nutrients or the percentile ranks of a food.
+    '''
+    try:
+        connection = connect_existing(args.db, 'rw' if args.rebuild else 'ro')
+        try:
+            if args.rebuild:
+                foods = nutrient_stats.rebuild_stats(connection, FOODS_TABLE)
+                print(f'Rebuilt the statistics of {foods} foods')
+                return 0
+            if args.food:
+                ranks = nutrient_stats.percentile_ranks(connection, args.food)
+            elif args.nutrient is not None:
+                stats = nutrient_stats.get_stats(connection, args.nutrient)
+            else:
+                foods = connection.execute(f'SELECT COUNT(*) FROM {FOODS_TABLE}').fetchone()[0]
+                columns = connection.execute(f'PRAGMA table_info({FOODS_TABLE})').fetchall()
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f'Error reading {args.db}: {e}', file=sys.stderr)
+        return 1
+
+    if args.food:
+        if not ranks:
+            print(f'Food not found: {args.food}', file=sys.stderr)
+            return 1
+        for nutrient, rank in ranks.items():
+            rank = 'n/a' if rank is None else f'{rank:.1f}'
+            print(f'{nutrient}: {rank} (percentile rank)')
+    elif args.nutrient is not None:
+        for nutrient in stats:
+            percentiles = ' '.join(f'p{p}={nutrient[f"p{p}"]:.4g}' for p in nutrient_stats.PERCENTILES)
+            unit = f' ({nutrient["unit"]})' if nutrient['unit'] else ''
+            print(f'{nutrient["nutrient"]}{unit}: count={nutrient["count"]} min={nutrient["min"]:.4g} '
+                  f'max={nutrient["max"]:.4g} mean={nutrient["mean"]:.4g} std={nutrient["std"]:.4g} {percentiles}')
+    else:
+        print(f'Foods: {foods}')
+        print(f'Nutrients: {len(columns) - 1}')
+    return 0
+
+def build_parser():
+    '''
+    Build the command line parser with one subcommand per task.
+    '''
+    parser = argparse.ArgumentParser(description='Analyze the nutrients of the foods you eat.')
+    parser.add_argument('--db', default=DB_FILE, help=f'SQLite database file (default: {DB_FILE})')
+    subparsers = parser.add_subparsers(dest='command')
+
+    fetch = subparsers.add_parser('fetch', help='download the foods and save them')
+    fetch.add_argument('--foods', default=CORRECTED_FOODS,
+                       help=f'file with valid USDA food names; if empty, {FOODS} is resolved first (default: {CORRECTED_FOODS})')
+    fetch.add_argument('--resolved-output', default=RESOLVED_FOODS,
+                       help=f'file the names resolved from {FOODS} are appended to when --foods is empty (default: {RESOLVED_FOODS})')
+    fetch.set_defaults(func=run_fetch)
+
+    resolve = subparsers.add_parser('resolve', help='find the USDA names of the foods you eat')
+    resolve.add_argument('--input', default=FOODS, help=f'file with the foods you eat (default: {FOODS})')
+    resolve.add_argument('--output', default=RESOLVED_FOODS, help=f'file the USDA names are appended to (default: {RESOLVED_FOODS})')
+    resolve.set_defaults(func=run_resolve)
+
+    export = subparsers.add_parser('export', help='export the db to a csv file')
+    export.add_argument('--output', default='food_components_export.csv', help='csv file to write (default: food_components_export.csv)')
+    export.set_defaults(func=run_export)
+
+    query = subparsers.add_parser('query', help='print the nutrients of a saved food')
+    query.add_argument('food', help='USDA name of the food')
+    query.add_argument('--nutrient', help='only print nutrients whose name contains this text')
+    query.set_defaults(func=run_query)
+
+    stats = subparsers.add_parser('stats', help='print a summary of the db or of its nutrients')
+    stats_mode = stats.add_mutually_exclusive_group()
+    stats_mode.add_argument('--nutrient', nargs='?', const='',
+                            help='print the distribution of the nutrients whose name contains this text, or of all of them')
+    stats_mode.add_argument('--food', help='print the percentile rank of a saved food for every nutrient')
+    stats_mode.add_argument('--rebuild', action='store_true', help='rebuild the statistics from the foods table')
+    stats.set_defaults(func=run_stats)
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    # Without a subcommand keep the original behaviour of fetching the foods
+    if args.command is None:
+        args = parser.parse_args(['--db', args.db, 'fetch'])
+
+    # Reject an empty output before any call to the USDA API
+    if args.command == 'fetch' and not args.foods and not args.resolved_output:
+        parser.error('--resolved-output cannot be empty when --foods is empty')
+    if args.command == 'resolve' and not args.output:
+        parser.error('--output cannot be empty')
+
+    return args.func(args)
 
 
 
@@ -622,4 +866,4 @@ def main():
 
 if __name__ == '__main__':
     # unique_foods_creator()
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,254 @@
+import math
+import sqlite3
+import logging
+
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+STATS_TABLE = 'nutrient_stats'
+VALUES_TABLE = 'nutrient_stats_values'
+# Unit of the values whose unit is not known, e.g. when rebuilt from foods_data
+UNKNOWN_UNIT = ''
+
+# Running moments per nutrient and unit, so values the USDA lists in
+# different units (e.g. Energy in KCAL and kJ) are never compared, plus
+# every food's values indexed by (nutrient, unit, value) so min, max,
+# quantiles and ranks are exact index lookups.
+SCHEMA = (
+    f'''CREATE TABLE IF NOT EXISTS {STATS_TABLE} (
+        nutrient TEXT NOT NULL,
+        unit TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        min REAL,
+        max REAL,
+        mean REAL NOT NULL,
+        m2 REAL NOT NULL,
+        PRIMARY KEY (nutrient, unit)
+    )''',
+    f'''CREATE TABLE IF NOT EXISTS {VALUES_TABLE} (
+        Food TEXT NOT NULL,
+        nutrient TEXT NOT NULL,
+        unit TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (Food, nutrient)
+    ) WITHOUT ROWID''',
+    f'CREATE INDEX IF NOT EXISTS ix_{VALUES_TABLE}_nutrient_value ON {VALUES_TABLE} (nutrient, unit, value)',
+)
+
+def create_stats_tables(connection):
+    '''
+    Create the statistics tables if they do not exist.
+    '''
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+def table_exists(connection, table):
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def numeric_values(nutrients):
+    '''
+    Keep only the nutrients with a finite numeric value.
+    '''
+    values = {}
+    for nutrient, value in nutrients.items():
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if math.isfinite(value):
+            values[nutrient] = value
+    return values
+
+def _add_value(connection, nutrient, unit, value):
+    row = connection.execute(
+        f'SELECT count, mean, m2 FROM {STATS_TABLE} WHERE nutrient = ? AND unit = ?', (nutrient, unit)
+    ).fetchone()
+    count, mean, m2 = row if row else (0, 0.0, 0.0)
+
+    # Welford's running mean and sum of squared differences
+    count += 1
+    delta = value - mean
+    mean += delta / count
+    m2 += delta * (value - mean)
+
+    connection.execute(
+        f'INSERT INTO {STATS_TABLE} (nutrient, unit, count, mean, m2) VALUES (?, ?, ?, ?, ?) '
+        f'ON CONFLICT (nutrient, unit) DO UPDATE SET count = excluded.count, mean = excluded.mean, m2 = excluded.m2',
+        (nutrient, unit, count, mean, m2)
+    )
+
+def _remove_value(connection, nutrient, unit, value):
+    row = connection.execute(
+        f'SELECT count, mean, m2 FROM {STATS_TABLE} WHERE nutrient = ? AND unit = ?', (nutrient, unit)
+    ).fetchone()
+    if row is None:
+        return
+    count, mean, m2 = row
+
+    if count <= 1:
+        connection.execute(f'DELETE FROM {STATS_TABLE} WHERE nutrient = ? AND unit = ?', (nutrient, unit))
+        return
+
+    # Welford's update run backwards
+    new_mean = (count * mean - value) / (count - 1)
+    m2 = max(m2 - (value - mean) * (value - new_mean), 0.0)
+
+    connection.execute(
+        f'UPDATE {STATS_TABLE} SET count = ?, mean = ?, m2 = ? WHERE nutrient = ? AND unit = ?',
+        (count - 1, new_mean, m2, nutrient, unit)
+    )
+
+def _refresh_min_max(connection, nutrient, unit):
+    # Served by the (nutrient, unit, value) index, so this does not scan the table
+    connection.execute(
+        f'UPDATE {STATS_TABLE} SET '
+        f'min = (SELECT MIN(value) FROM {VALUES_TABLE} WHERE nutrient = ? AND unit = ?), '
+        f'max = (SELECT MAX(value) FROM {VALUES_TABLE} WHERE nutrient = ? AND unit = ?) '
+        f'WHERE nutrient = ? AND unit = ?',
+        (nutrient, unit, nutrient, unit, nutrient, unit)
+    )
+
+def _update_food(connection, food, new_values, units):
+    # Compare (unit, value) pairs so a nutrient whose unit changed moves to its new statistics
+    new_values = {
+        nutrient: (units.get(nutrient, UNKNOWN_UNIT), value) for nutrient, value in new_values.items()
+    }
+    old_values = {
+        nutrient: (unit, value) for nutrient, unit, value in connection.execute(
+            f'SELECT nutrient, unit, value FROM {VALUES_TABLE} WHERE Food = ?', (food,)
+        ).fetchall()
+    }
+
+    changed = set()
+    for nutrient, (unit, value) in old_values.items():
+        if new_values.get(nutrient) != (unit, value):
+            _remove_value(connection, nutrient, unit, value)
+            changed.add((nutrient, unit))
+    for nutrient, (unit, value) in new_values.items():
+        if old_values.get(nutrient) != (unit, value):
+            _add_value(connection, nutrient, unit, value)
+            changed.add((nutrient, unit))
+
+    connection.execute(f'DELETE FROM {VALUES_TABLE} WHERE Food = ?', (food,))
+    connection.executemany(
+        f'INSERT INTO {VALUES_TABLE} (Food, nutrient, unit, value) VALUES (?, ?, ?, ?)',
+        [(food, nutrient, unit, value) for nutrient, (unit, value) in new_values.items()]
+    )
+
+    for nutrient, unit in changed:
+        _refresh_min_max(connection, nutrient, unit)
+
+    return changed
+
+def update_stats(connection, food, nutrients, units=None):
+    '''
+    Incrementally update the statistics after a food has been upserted:
+    the previous values of the food are removed and the new ones added.
+    units maps each nutrient to its unit; nutrients without one use UNKNOWN_UNIT.
+    '''
+    create_stats_tables(connection)
+    with connection:
+        changed = _update_food(connection, food, numeric_values(nutrients), units or {})
+
+    logging.info(f'Updated statistics of {len(changed)} nutrients for {food}')
+
+def rebuild_stats(connection, table='foods_data'):
+    '''
+    Build the statistics again with a single scan of the foods table, e.g. for
+    databases created before the statistics existed. foods_data has no units,
+    so the units already known from the previous statistics are kept and the
+    other values get UNKNOWN_UNIT. Everything runs in one transaction, so a
+    failure leaves the previous statistics untouched.
+    '''
+    if not table_exists(connection, table):
+        raise sqlite3.OperationalError(f'no such table: {table}')
+
+    cursor = connection.execute(f'SELECT * FROM {table}')
+    columns = [description[0] for description in cursor.description]
+    rows = cursor.fetchall()
+
+    known_units = {}
+    if table_exists(connection, VALUES_TABLE):
+        for food, nutrient, unit in connection.execute(f'SELECT Food, nutrient, unit FROM {VALUES_TABLE}'):
+            known_units.setdefault(food, {})[nutrient] = unit
+
+    with connection:
+        connection.execute('BEGIN')
+        for stats_table in (STATS_TABLE, VALUES_TABLE):
+            connection.execute(f'DROP TABLE IF EXISTS {stats_table}')
+        create_stats_tables(connection)
+        for row in rows:
+            food_data = dict(zip(columns, row))
+            food = food_data.pop('Food')
+            _update_food(connection, food, numeric_values(food_data), known_units.get(food, {}))
+
+    return len(rows)
+
+def _quantile(connection, nutrient, unit, count, percentile):
+    # Nearest-rank percentile, read from the (nutrient, unit, value) index
+    offset = round(percentile / 100 * (count - 1))
+    return connection.execute(
+        f'SELECT value FROM {VALUES_TABLE} WHERE nutrient = ? AND unit = ? ORDER BY value LIMIT 1 OFFSET ?',
+        (nutrient, unit, offset)
+    ).fetchone()[0]
+
+def get_stats(connection, nutrient=None):
+    '''
+    Return count, min, max, mean, standard deviation and PERCENTILES of every
+    nutrient and unit, or only of the nutrients whose name contains the given text.
+    '''
+    query = f'SELECT nutrient, unit, count, min, max, mean, m2 FROM {STATS_TABLE}'
+    params = ()
+    if nutrient:
+        # Plain case-insensitive substring match, like query --nutrient
+        query += ' WHERE instr(lower(nutrient), lower(?)) > 0'
+        params = (nutrient,)
+    query += ' ORDER BY nutrient, unit'
+
+    stats = []
+    for name, unit, count, minimum, maximum, mean, m2 in connection.execute(query, params).fetchall():
+        nutrient_stats = {
+            'nutrient': name,
+            'unit': unit,
+            'count': count,
+            'min': minimum,
+            'max': maximum,
+            'mean': mean,
+            'std': math.sqrt(m2 / (count - 1)) if count > 1 else 0.0,
+        }
+        for percentile in PERCENTILES:
+            nutrient_stats[f'p{percentile}'] = _quantile(connection, name, unit, count, percentile)
+        stats.append(nutrient_stats)
+
+    return stats
+
+def percentile_rank(connection, nutrient, value, unit=UNKNOWN_UNIT):
+    '''
+    Return the percentage (0-100) of foods with less of the nutrient than value,
+    among the foods with the nutrient in the same unit, counting foods with the
+    same value as half, or None if the nutrient is unknown in that unit.
+    '''
+    row = connection.execute(
+        f'SELECT count FROM {STATS_TABLE} WHERE nutrient = ? AND unit = ?', (nutrient, unit)
+    ).fetchone()
+    if row is None:
+        return None
+    below, same = connection.execute(
+        f'SELECT '
+        f'(SELECT COUNT(*) FROM {VALUES_TABLE} WHERE nutrient = ? AND unit = ? AND value < ?), '
+        f'(SELECT COUNT(*) FROM {VALUES_TABLE} WHERE nutrient = ? AND unit = ? AND value = ?)',
+        (nutrient, unit, value, nutrient, unit, value)
+    ).fetchone()
+    return 100 * (below + same / 2) / row[0]
+
+def percentile_ranks(connection, food):
+    '''
+    Return the percentile rank of a food for every nutrient it has, using only
+    the statistics tables instead of scanning the foods table.
+    '''
+    values = connection.execute(
+        f'SELECT nutrient, unit, value FROM {VALUES_TABLE} WHERE Food = ? ORDER BY nutrient', (food,)
+    ).fetchall()
+    return {nutrient: percentile_rank(connection, nutrient, value, unit) for nutrient, unit, value in values}
@@ -0,0 +1,115 @@
+import sys
+from array import array
+
+
+# Factors used to express every mass-based nutrient in mg
+MG_FACTORS = {
+    'µg': 0.001,
+    'g': 1000,
+    'mg': 1,
+}
+
+def to_mg(value, unit):
+    '''
+    Convert a value to mg if necessary and return it with its resulting unit.
+    '''
+    factor = MG_FACTORS.get(unit)
+    if factor is None:
+        return value, unit
+    return value * factor, 'mg'
+
+
+class NutrientCatalog:
+    '''
+    Intern nutrient names and units into small integer ids shared by every
+    FoodRecord, so each food stores numbers instead of repeating long strings.
+    '''
+    __slots__ = ('_ids', 'names', 'units')
+
+    def __init__(self):
+        self._ids = {}
+        self.names = []
+        self.units = []
+
+    def intern(self, name, unit):
+        '''
+        Return the id of a (name, unit) pair, registering it if it is new.
+        '''
+        key = (name, unit)
+        nutrient_id = self._ids.get(key)
+        if nutrient_id is None:
+            nutrient_id = len(self.names)
+            self._ids[key] = nutrient_id
+            self.names.append(sys.intern(name))
+            self.units.append(sys.intern(unit))
+        return nutrient_id
+
+
+class FoodRecord:
+    '''
+    Compact in-memory representation of a food: float values indexed by
+    catalog id plus a presence mask telling which nutrients the food has.
+    '''
+    __slots__ = ('food', 'catalog', 'values', 'mask')
+
+    def __init__(self, food, catalog):
+        self.food = food
+        self.catalog = catalog
+        self.values = array('d')
+        self.mask = bytearray()
+
+    def set(self, nutrient_id, value):
+        '''
+        Store a value, growing the arrays up to the given catalog id.
+        '''
+        missing = nutrient_id + 1 - len(self.values)
+        if missing > 0:
+            self.values.extend([0.0] * missing)
+            self.mask.extend(bytes(missing))
+        self.values[nutrient_id] = value
+        self.mask[nutrient_id] = 1
+
+    def items(self):
+        '''
+        Yield (nutrient_id, value) for every nutrient present in the food.
+        '''
+        for nutrient_id, present in enumerate(self.mask):
+            if present:
+                yield nutrient_id, self.values[nutrient_id]
+
+    def to_dict(self):
+        '''
+        Materialize the record as the {'Food': ..., nutrient name: value} dict
+        used by the json, csv and db writers.
+        '''
+        food_dict = {'Food': self.food}
+        names = self.catalog.names
+        for nutrient_id, value in self.items():
+            food_dict[names[nutrient_id]] = value
+        return food_dict
+
+    @classmethod
+    def from_list(cls, food, data, catalog):
+        '''
+        Build a record from [nutrient, value, unit] lists, converting to mg.
+        Nutrients without a value are left out of the presence mask. When a
+        nutrient is listed in several units (e.g. Energy in kcal and kJ) the
+        last one listed for the food wins, as in list_to_dict.
+        '''
+        record = cls(food, catalog)
+        ids_by_name = {}
+        for nutrient, value, unit in data:
+            if value is None:
+                continue
+            value, unit = to_mg(value, unit)
+            nutrient_id = catalog.intern(nutrient, unit)
+            previous_id = ids_by_name.get(nutrient)
+            if previous_id is not None and previous_id != nutrient_id:
+                record.mask[previous_id] = 0
+            ids_by_name[nutrient] = nutrient_id
+            record.set(nutrient_id, value)
+        return record
+
+
+# Catalog shared by every record built during a run
+CATALOG = NutrientCatalog()
@@ -0,0 +1,171 @@
+import math
+import random
+import sqlite3
+import statistics
+
+import pytest
+
+import nutrient_stats
+
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(':memory:')
+    yield connection
+    connection.close()
+
+def random_foods(rng, count):
+    '''
+    Build foods where some nutrients are missing, as in the USDA data.
+    '''
+    foods = {}
+    for i in range(count):
+        nutrients = {'Iron, Fe': rng.lognormvariate(0, 1), 'Protein': rng.uniform(0, 30)}
+        if rng.random() < 0.5:
+            nutrients['Vitamin C'] = rng.choice([0.0, 0.5, 1.0, rng.uniform(0, 100)])
+        foods[f'Food {i}'] = nutrients
+    return foods
+
+def assert_matches(connection, foods):
+    '''
+    Compare the incremental statistics with a direct recomputation.
+    '''
+    stats = {row['nutrient']: row for row in nutrient_stats.get_stats(connection)}
+    nutrients = {nutrient for values in foods.values() for nutrient in values}
+    assert set(stats) == nutrients
+
+    for nutrient in nutrients:
+        values = sorted(food[nutrient] for food in foods.values() if nutrient in food)
+        row = stats[nutrient]
+        assert row['count'] == len(values)
+        assert row['min'] == values[0]
+        assert row['max'] == values[-1]
+        assert math.isclose(row['mean'], statistics.mean(values), rel_tol=1e-9, abs_tol=1e-9)
+        expected_std = statistics.stdev(values) if len(values) > 1 else 0.0
+        assert math.isclose(row['std'], expected_std, rel_tol=1e-6, abs_tol=1e-9)
+        for percentile in nutrient_stats.PERCENTILES:
+            assert row[f'p{percentile}'] == values[round(percentile / 100 * (len(values) - 1))]
+
+def test_incremental_stats_match_recomputation(connection):
+    rng = random.Random(1)
+    foods = random_foods(rng, 200)
+    for food, nutrients in foods.items():
+        nutrient_stats.update_stats(connection, food, nutrients)
+
+    assert_matches(connection, foods)
+
+def test_replacing_foods_matches_recomputation(connection):
+    rng = random.Random(2)
+    foods = random_foods(rng, 200)
+    for food, nutrients in foods.items():
+        nutrient_stats.update_stats(connection, food, nutrients)
+
+    # Replace some foods with new values and drop nutrients from others
+    for food in rng.sample(sorted(foods), 80):
+        foods[food] = random_foods(rng, 1)['Food 0']
+        nutrient_stats.update_stats(connection, food, foods[food])
+    for food in rng.sample(sorted(foods), 40):
+        foods[food] = {'Protein': foods[food]['Protein']}
+        nutrient_stats.update_stats(connection, food, foods[food])
+
+    assert_matches(connection, foods)
+
+def test_removing_every_value_of_a_nutrient(connection):
+    nutrient_stats.update_stats(connection, 'Apple', {'Iron, Fe': 0.1, 'Vitamin C': 4.6})
+    nutrient_stats.update_stats(connection, 'Apple', {'Iron, Fe': 0.2})
+
+    stats = nutrient_stats.get_stats(connection)
+    assert [row['nutrient'] for row in stats] == ['Iron, Fe']
+    assert stats[0]['count'] == 1
+    assert stats[0]['min'] == stats[0]['max'] == 0.2
+    assert nutrient_stats.percentile_rank(connection, 'Vitamin C', 4.6) is None
+
+def test_nutrient_filter_is_a_plain_substring(connection):
+    nutrient_stats.update_stats(connection, 'Apple', {'Iron, Fe': 0.1, 'Vitamin B-12': 0.0, 'Fatty acids, 50%': 1.0})
+
+    def names(text):
+        return [row['nutrient'] for row in nutrient_stats.get_stats(connection, text)]
+
+    assert names('iron') == ['Iron, Fe']
+    assert names('Iron_') == []
+    assert names('%') == ['Fatty acids, 50%']
+
+def test_units_are_kept_apart(connection):
+    nutrient_stats.update_stats(connection, 'Apple', {'Energy': 52.0}, {'Energy': 'KCAL'})
+    nutrient_stats.update_stats(connection, 'Banana', {'Energy': 89.0}, {'Energy': 'KCAL'})
+    nutrient_stats.update_stats(connection, 'Salmon', {'Energy': 600.0}, {'Energy': 'kJ'})
+
+    stats = {row['unit']: row for row in nutrient_stats.get_stats(connection, 'Energy')}
+    assert set(stats) == {'KCAL', 'kJ'}
+    assert stats['KCAL']['count'] == 2
+    assert stats['KCAL']['max'] == 89.0
+    assert stats['kJ']['count'] == 1
+    # Salmon is only compared with the foods listing Energy in kJ
+    assert nutrient_stats.percentile_ranks(connection, 'Salmon') == {'Energy': 50.0}
+    assert nutrient_stats.percentile_ranks(connection, 'Banana') == {'Energy': 75.0}
+
+    # A food whose unit changes moves from one distribution to the other
+    nutrient_stats.update_stats(connection, 'Banana', {'Energy': 372.0}, {'Energy': 'kJ'})
+    stats = {row['unit']: row for row in nutrient_stats.get_stats(connection, 'Energy')}
+    assert stats['KCAL']['count'] == 1
+    assert stats['KCAL']['max'] == 52.0
+    assert stats['kJ']['count'] == 2
+    assert nutrient_stats.percentile_rank(connection, 'Energy', 52.0) is None
+
+def test_rebuild_keeps_known_units(connection):
+    connection.execute('CREATE TABLE foods_data (Food VARCHAR PRIMARY KEY, "Energy" VARCHAR)')
+    connection.executemany('INSERT INTO foods_data VALUES (?, ?)', [('Apple', '52.0'), ('Salmon', '600.0')])
+    connection.commit()
+    nutrient_stats.update_stats(connection, 'Apple', {'Energy': 52.0}, {'Energy': 'KCAL'})
+    nutrient_stats.update_stats(connection, 'Salmon', {'Energy': 600.0}, {'Energy': 'kJ'})
+
+    nutrient_stats.rebuild_stats(connection)
+
+    assert [(row['unit'], row['count']) for row in nutrient_stats.get_stats(connection)] == [('KCAL', 1), ('kJ', 1)]
+
+def test_non_numeric_values_are_ignored(connection):
+    nutrient_stats.update_stats(connection, 'Apple', {'Iron, Fe': '0.1', 'Note': 'n/a', 'Zinc': 'nan'})
+
+    assert [row['nutrient'] for row in nutrient_stats.get_stats(connection)] == ['Iron, Fe']
+
+def test_percentile_rank_is_monotonic(connection):
+    rng = random.Random(3)
+    foods = random_foods(rng, 100)
+    for food, nutrients in foods.items():
+        nutrient_stats.update_stats(connection, food, nutrients)
+
+    values = sorted(food['Iron, Fe'] for food in foods.values())
+    probes = sorted(values + [0.0, values[-1] * 2] + [rng.uniform(0, values[-1]) for _ in range(50)])
+    ranks = [nutrient_stats.percentile_rank(connection, 'Iron, Fe', value) for value in probes]
+    assert ranks == sorted(ranks)
+    assert ranks[0] == 0
+    assert ranks[-1] == 100
+
+def test_percentile_ranks_of_a_food(connection):
+    for i, iron in enumerate([1.0, 2.0, 3.0, 4.0]):
+        nutrient_stats.update_stats(connection, f'Food {i}', {'Iron, Fe': iron})
+
+    assert nutrient_stats.percentile_ranks(connection, 'Food 2') == {'Iron, Fe': 62.5}
+    assert nutrient_stats.percentile_ranks(connection, 'Unknown') == {}
+
+def test_rebuild_matches_incremental(connection):
+    rng = random.Random(4)
+    foods = random_foods(rng, 50)
+    connection.execute('CREATE TABLE foods_data (Food VARCHAR PRIMARY KEY, "Iron, Fe" VARCHAR, "Protein" VARCHAR)')
+    connection.executemany(
+        'INSERT INTO foods_data VALUES (?, ?, ?)',
+        [(food, str(values['Iron, Fe']), str(values['Protein'])) for food, values in foods.items()]
+    )
+    connection.commit()
+
+    assert nutrient_stats.rebuild_stats(connection) == len(foods)
+    assert_matches(connection, {
+        food: {'Iron, Fe': values['Iron, Fe'], 'Protein': values['Protein']} for food, values in foods.items()
+    })
+
+def test_rebuild_without_foods_table_keeps_stats(connection):
+    nutrient_stats.update_stats(connection, 'Apple', {'Iron, Fe': 0.1})
+
+    with pytest.raises(sqlite3.OperationalError):
+        nutrient_stats.rebuild_stats(connection)
+    assert nutrient_stats.get_stats(connection)[0]['count'] == 1
@@ -0,0 +1,67 @@
+import pytest
+
+from records import FoodRecord, NutrientCatalog, to_mg
+
+
+@pytest.mark.parametrize('value, unit, expected', [
+    (250, 'µg', (0.25, 'mg')),
+    (1.5, 'g', (1500, 'mg')),
+    (3, 'mg', (3, 'mg')),
+    (52, 'KCAL', (52, 'KCAL')),
+])
+def test_to_mg(value, unit, expected):
+    assert to_mg(value, unit) == pytest.approx(expected)
+
+def test_from_list_converts_to_mg():
+    record = FoodRecord.from_list('Apple', [
+        ['Vitamin B-12', 250, 'µg'],
+        ['Protein', 0.26, 'g'],
+        ['Iron, Fe', 0.12, 'mg'],
+    ], NutrientCatalog())
+
+    assert record.to_dict() == pytest.approx({
+        'Food': 'Apple',
+        'Vitamin B-12': 0.25,
+        'Protein': 260,
+        'Iron, Fe': 0.12,
+    })
+
+def test_to_dict_keeps_full_precision():
+    record = FoodRecord.from_list('Apple', [['Iron, Fe', 0.123456789, 'mg']], NutrientCatalog())
+
+    assert record.to_dict()['Iron, Fe'] == 0.123456789
+
+@pytest.mark.parametrize('energy, expected', [
+    ([['Energy', 48, 'KCAL'], ['Energy', 200, 'kJ']], 200),
+    ([['Energy', 200, 'kJ'], ['Energy', 48, 'KCAL']], 48),
+])
+def test_last_unit_listed_wins(energy, expected):
+    catalog = NutrientCatalog()
+    # Intern both units in the opposite order first, so the catalog order cannot decide
+    FoodRecord.from_list('Other', energy[::-1], catalog)
+
+    record = FoodRecord.from_list('Apple', energy, catalog)
+
+    assert record.to_dict() == {'Food': 'Apple', 'Energy': expected}
+
+def test_none_value_is_left_out():
+    record = FoodRecord.from_list('Apple', [
+        ['Iron, Fe', 0.12, 'mg'],
+        ['Iron, Fe', None, 'mg'],
+        ['Zinc, Zn', None, 'mg'],
+    ], NutrientCatalog())
+
+    # A missing value does not override a known one and is not saved
+    assert record.to_dict() == {'Food': 'Apple', 'Iron, Fe': 0.12}
+
+def test_foods_share_one_catalog():
+    catalog = NutrientCatalog()
+    apple = FoodRecord.from_list('Apple', [['Iron, Fe', 0.12, 'mg'], ['Protein', 0.26, 'g']], catalog)
+    salmon = FoodRecord.from_list('Salmon', [['Protein', 19.8, 'g'], ['Vitamin D', 11, 'µg']], catalog)
+
+    assert catalog.names == ['Iron, Fe', 'Protein', 'Vitamin D']
+    assert catalog.units == ['mg', 'mg', 'mg']
+    assert apple.to_dict() == pytest.approx({'Food': 'Apple', 'Iron, Fe': 0.12, 'Protein': 260})
+    assert salmon.to_dict() == pytest.approx({'Food': 'Salmon', 'Protein': 19800, 'Vitamin D': 0.011})
+    # The first food is not affected by nutrients interned after it
+    assert len(apple.values) == 2
@@ -4,7 +4,6 @@ import json
 import logging
 import configparser
 from datetime import datetime
-from dotenv import load_dotenv, dotenv_values
 
 def results_configurator() -> str:
     '''
@@ -76,6 +75,8 @@ def load_env_file():
     '''
     Load the ini configuration file.
     '''
+    from dotenv import load_dotenv, dotenv_values
+
     if load_dotenv():
         return dotenv_values()
     
@@ -86,13 +87,14 @@ def execution_time(func):
     Decorator that prints the current date and time before and after
     executing the given function, and measures the time taken for execution.
     '''
-    def wrapper():
+    def wrapper(*args, **kwargs):
         current_datetime = datetime.now()
         formatted_datetime = current_datetime.strftime('%Y%m%d_%H%M%S')
         print(f'Program started at {formatted_datetime}')
-        func()
+        result = func(*args, **kwargs)
         current_datetime = datetime.now()
         formatted_datetime = current_datetime.strftime('%Y%m%d_%H%M%S')
         print(f'Program ended at {formatted_datetime}')
+        return result
 
     return wrapper
\ No newline at end of file